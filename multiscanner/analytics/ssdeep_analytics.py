@@ -39,6 +39,16 @@ from multiscanner.common import utils
 from multiscanner.storage import storage
 
 
+# Samples that ssdeep_compare has not been run on yet
+UNANALYZED_QUERY = {
+    'bool': {
+        'must': [
+            {'match': {'ssdeep.analyzed': 'false'}}
+        ]
+    }
+}
+
+
 class SSDeepAnalytic:
 
     def __init__(self, debug=False):
@@ -69,13 +79,7 @@ class SSDeepAnalytic:
         # e.g., ssdeepmeta.analyzed == false
         query = {
             '_source': ['ssdeep', 'SHA256'],
-            'query': {
-                'bool': {
-                    'must': [
-                        {'match': {'ssdeep.analyzed': 'false'}}
-                    ]
-                }
-            }
+            'query': UNANALYZED_QUERY
         }
 
         page = self.es.search(
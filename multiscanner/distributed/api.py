@@ -88,8 +88,9 @@ DEFAULTCONF = {
     'web_loc': 'http://localhost:80',
     'cors': r'https?://localhost(:\d+)?',
     'batch_size': 100,
-    'batch_interval': 60   # Number of seconds to wait for additional files
+    'batch_interval': 60,  # Number of seconds to wait for additional files
                            # submitted to the create/ API
+    'celery_batch_size': 8,  # Most files scanned by one Celery task in distributed mode
 }
 
 
@@ -123,7 +124,9 @@ api_config = utils.parse_config(api_config_object)
 
 # TODO: fix this mess
 # Needs api_config in order to function properly
-from multiscanner.distributed.celery_worker import multiscanner_celery, ssdeep_compare_celery
+from multiscanner.distributed.celery_worker import (multiscanner_celery, multiscanner_celery_batch,
+                                                    ssdeep_compare_celery, priority_options,
+                                                    SCAN_PRIORITIES)
 from multiscanner.analytics.ssdeep_analytics import SSDeepAnalytic
 
 db = database.Database(config=api_config.get('Database'))
@@ -181,6 +184,9 @@ CORS(app, origins=cors_origins)
 
 batch_size = api_config['api'].get('batch_size', 10)
 batch_interval = api_config['api'].get('batch_interval', 100)
+# Kept small: a Celery batch is scanned by one worker process, and is
+# redelivered or marked Failed as a whole
+celery_batch_size = int(api_config['api'].get('celery_batch_size', DEFAULTCONF['celery_batch_size']))
 # Add `delete_after_scan = True` to api_config.ini to delete samples after scan has completed
 delete_after_scan = api_config['api'].get('delete_after_scan', False)
 
@@ -225,8 +231,7 @@ def multiscanner_process(work_queue, exit_signal):
 
         for item in metadata_list:
             # Use the original filename as the index instead of the full path
-            results[item[1]] = results[item[0]]
-            del results[item[0]]
+            results[item[1]] = results.pop(item[0])
 
             results[item[1]]['Scan Metadata'] = item[4]
             results[item[1]]['Scan Metadata']['Scan Time'] = scan_time
@@ -427,33 +432,80 @@ def import_task(file_):
     return task_id
 
 
-def queue_task(original_filename, f_name, full_path, metadata, rescan=False):
+def _add_task(original_filename, f_name, full_path, metadata, rescan=False):
     '''
-    Queue up a single new task, for a single non-archive file.
+    Add a task for a file to the task DB. Outside of distributed mode it is
+    also put on the local work queue. Returns (task_id, item), where item is
+    the work item still to be sent to Celery, or None if no new scan is
+    needed or it has already been queued locally.
     '''
     # If option set, or no scan exists for this sample, skip and scan sample again
     # Otherwise, pull latest scan for this sample
     if not rescan:
         t_exists = db.exists(f_name)
         if t_exists:
-            return t_exists
+            return t_exists, None
 
     # Add task to sqlite DB
     # Make the sample_id equal the sha256 hash
     task_id = db.add_task(sample_id=f_name)
 
-    if DISTRIBUTED:
-        # Publish the task to Celery
-        multiscanner_celery.delay(full_path, original_filename,
-                                  task_id, f_name, metadata,
-                                  config=MS_CONFIG)
-    else:
+    item = (full_path, original_filename, task_id, f_name, metadata)
+    if not DISTRIBUTED:
         # Put the task on the queue
-        work_queue.put((full_path, original_filename, task_id, f_name, metadata))
+        work_queue.put(item)
+        return task_id, None
+    return task_id, item
+
+
+def queue_task(original_filename, f_name, full_path, metadata, rescan=False, priority='medium'):
+    '''
+    Queue up a single new task, for a single non-archive file. In distributed
+    mode, priority picks the Celery queue the task is sent to.
+    '''
+    task_id, item = _add_task(original_filename, f_name, full_path, metadata, rescan)
+
+    if item is not None:
+        # Publish the task to Celery
+        multiscanner_celery.apply_async(
+            args=item,
+            kwargs={'config': MS_CONFIG},
+            **priority_options(priority)
+        )
 
     return task_id
 
 
+def queue_tasks(files, metadata, rescan=False, priority='medium'):
+    '''
+    Queue up new tasks for a list of (original_filename, f_name, full_path)
+    tuples, e.g. the contents of an archive. In distributed mode the files
+    are sent to Celery in batches of celery_batch_size, each scanned by one
+    task.
+    '''
+    task_id_list = []
+    batch = []
+    queued = {}
+    for original_filename, f_name, full_path in files:
+        # The same file may show up more than once in an archive
+        if f_name not in queued:
+            task_id, item = _add_task(original_filename, f_name, full_path, metadata, rescan)
+            queued[f_name] = task_id
+            if item is not None:
+                batch.append(item)
+        task_id_list.append(queued[f_name])
+
+    # Publish the tasks to Celery
+    for i in range(0, len(batch), celery_batch_size):
+        multiscanner_celery_batch.apply_async(
+            args=(batch[i:i + celery_batch_size],),
+            kwargs={'config': MS_CONFIG},
+            **priority_options(priority)
+        )
+
+    return task_id_list
+
+
 @app.route('/api/v1/tasks', methods=['POST'])
 def create_task():
     '''
@@ -488,6 +540,7 @@ def create_task():
     task_id_list = []
     extract_dir = None
     rescan = False
+    priority = 'medium'
     for key in request.form.keys():
         if key in ['file_id', 'archive-password', 'upload_type'] or request.form[key] == '':
             continue
@@ -496,6 +549,13 @@ def create_task():
                 rescan = False
             elif request.form[key] == 'rescan':
                 rescan = True
+        elif key == 'priority':
+            priority = request.form[key]
+            if priority not in SCAN_PRIORITIES:
+                return make_response(
+                    jsonify({'Message': "'priority' must be one of: {}".format(
+                        ', '.join(sorted(SCAN_PRIORITIES)))}),
+                    HTTP_BAD_REQUEST)
         elif key == 'modules':
             module_names = request.form[key]
             files = utils.parseDir(MODULESDIR, True)
@@ -530,11 +590,12 @@ def create_task():
                 # NOTE: zipfile module prior to Py 2.7.4 is insecure!
                 # https://docs.python.org/2/library/zipfile.html#zipfile.ZipFile.extract
                 z.extractall(path=extract_dir, pwd=password)
+                files = []
                 for uzfile in z.namelist():
                     unzipped_file = open(os.path.join(extract_dir, uzfile))
                     f_name, full_path = save_hashed_filename(unzipped_file, True)
-                    tid = queue_task(uzfile, f_name, full_path, metadata, rescan=rescan)
-                    task_id_list.append(tid)
+                    files.append((uzfile, f_name, full_path))
+                task_id_list = queue_tasks(files, metadata, rescan=rescan, priority=priority)
             except RuntimeError as e:
                 msg = "ERROR: Failed to extract " + str(file_) + ' - ' + str(e)
                 return make_response(
@@ -545,11 +606,12 @@ def create_task():
             r = rarfile.RarFile(file_)
             try:
                 r.extractall(path=extract_dir, pwd=password)
+                files = []
                 for urfile in r.namelist():
                     unrarred_file = open(os.path.join(extract_dir, urfile))
                     f_name, full_path = save_hashed_filename(unrarred_file, True)
-                    tid = queue_task(urfile, f_name, full_path, metadata, rescan=rescan)
-                    task_id_list.append(tid)
+                    files.append((urfile, f_name, full_path))
+                task_id_list = queue_tasks(files, metadata, rescan=rescan, priority=priority)
             except RuntimeError as e:
                 msg = "ERROR: Failed to extract " + str(file_) + ' - ' + str(e)
                 return make_response(
@@ -558,7 +620,7 @@ def create_task():
     else:
         # File was not an archive to extract
         f_name, full_path = save_hashed_filename(file_)
-        tid = queue_task(original_filename, f_name, full_path, metadata, rescan=rescan)
+        tid = queue_task(original_filename, f_name, full_path, metadata, rescan=rescan, priority=priority)
         task_id_list = [tid]
 
     msg = {'task_ids': task_id_list}
@@ -1,29 +1,72 @@
 '''
 This is the multiscanner celery worker. To initialize a worker node run:
-$ celery -A celery_worker worker
+$ celery -A celery_worker worker -Ofair
 from the utils/ directory.
+
+Scan times vary a lot between files, so each worker process only reserves
+one task at a time and -Ofair hands tasks to whichever process is free,
+instead of queueing them behind a long running scan.
+
+By default a scan task returns, and with late acks is acknowledged, as
+soon as multiscan finishes. Its reports are then built in a background
+thread and buffered for up to flush_interval seconds before they are
+stored and the task DB is updated. A worker process that is killed
+(SIGKILL, the OOM killer) in that window loses those reports, and their
+tasks stay Pending: the broker has nothing left to redeliver. Set
+store_before_ack = True in the [celery] section of the API config to
+have each task hand its own reports to every loaded storage module and
+write its own task DB update before it returns. A task is then only
+acknowledged once all of that has completed without raising, and one
+that raises is recorded as Failed. Whether a write that didn't raise
+was durable is still up to each storage module.
+
+If the enabled modules mostly wait on remote services (sandboxes, AV
+scanners, lookups) rather than the CPU, a green thread pool can run many
+more scans per node than one process per core:
+$ celery -A celery_worker worker -P gevent -c 100
+Celery monkey patches the standard library itself when it is started
+with -P gevent or -P eventlet, so nothing needs to change here. Modules
+that do their work in Python (hashing, entropy, yara) still share a single
+core, and the task DB driver has to be made cooperative for DB writes to
+stop blocking the other scans (e.g. psycogreen for psycopg2).
 '''
 
 import codecs
 import configparser
 import os
+import queue
+import threading
+import time
+from collections import deque, namedtuple
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from socket import gethostname
 
 from celery import Celery, Task
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
 from celery.schedules import crontab
 from celery.utils.log import get_task_logger
+from kombu import Exchange, Queue
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
 
 from multiscanner import CONFIG as MS_CONFIG
 from multiscanner import multiscan, parse_reports
 from multiscanner.common import utils
-from multiscanner.storage import elasticsearch_storage, storage
+from multiscanner.storage import storage
 from multiscanner.storage import sql_driver as database
-from multiscanner.analytics.ssdeep_analytics import SSDeepAnalytic
 
 
 logger = get_task_logger(__name__)
 
+WORKER_HOSTNAME = gethostname()
+
+# Separates the log output of each scanned file
+_BANNER = '=' * 48 + '\n'
+
 DEFAULTCONF = {
     'protocol': 'pyamqp',
     'host': 'localhost',
@@ -32,6 +75,9 @@ DEFAULTCONF = {
     'vhost': '/',
     'flush_every': '100',
     'flush_interval': '10',
+    'store_before_ack': 'False',
+    'max_tasks_per_child': '100',  # 0 disables recycling after N tasks
+    'max_memory_per_child_kb': '524288',  # 0 disables the memory limit
     'tz': 'US/Eastern',
 }
 
@@ -60,15 +106,110 @@ storage_config_object.read(storage_configfile)
 config = utils.parse_config(storage_config_object)
 es_storage_config = config.get('ElasticSearchStorage')
 
-app = Celery(broker='{0}://{1}:{2}@{3}/{4}'.format(
-    worker_config.get('protocol'),
-    worker_config.get('user'),
-    worker_config.get('password'),
-    worker_config.get('host'),
-    worker_config.get('vhost'),
-))
+# The Elasticsearch settings used by the periodic tasks, with their
+# defaults filled in once at import
+ElasticSearchSettings = namedtuple('ElasticSearchSettings', [
+    'metricbeat_enabled',
+    'metricbeat_rollover_days',
+])
+ES_CFG = ElasticSearchSettings(
+    metricbeat_enabled=es_storage_config.get('metricbeat_enabled', True),
+    metricbeat_rollover_days=int(es_storage_config.get('metricbeat_rollover_days') or 7),
+)
+
+
+def _broker_url(worker_config):
+    '''
+    Build the broker URL from the celery config. The user, password and
+    vhost are quoted, so characters like '@', ':' and '/' (RabbitMQ's
+    default vhost) can't be mistaken for URL delimiters.
+    '''
+    return '{0}://{1}:{2}@{3}/{4}'.format(
+        worker_config.get('protocol'),
+        quote(str(worker_config.get('user')), safe=''),
+        quote(str(worker_config.get('password')), safe=''),
+        worker_config.get('host'),
+        quote(str(worker_config.get('vhost')), safe=''),
+    )
+
+
+def _recycle_limit(worker_config, key):
+    '''
+    Return a child recycling limit from the celery config. Celery wants
+    None rather than 0 to disable one, so 0, None and empty values map to
+    None.
+    '''
+    value = worker_config.get(key, DEFAULTCONF[key])
+    if value in (None, ''):
+        return None
+    return int(value) or None
+
+
+app = Celery(broker=_broker_url(worker_config))
 app.conf.timezone = worker_config.get('tz')
+# Keep broker connections open and reuse them, so the REST API doesn't
+# connect for every scan it submits, and wait for the broker to confirm
+# each message so none are lost if it restarts
+app.conf.broker_pool_limit = 100
+app.conf.broker_heartbeat = 30
+app.conf.broker_transport_options = {'confirm_publish': True}
+app.conf.result_expires = 3600
+
+# Tasks are routed to one of three queues by priority. Within a queue,
+# RabbitMQ delivers messages with a higher priority first.
+SCAN_PRIORITIES = {
+    'low': 1,
+    'medium': 5,
+    'high': 9,
+}
+task_exchange = Exchange('tasks', type='direct')
+# Every queue must accept the full range of priorities
+_QUEUE_ARGS = {'x-max-priority': 10}
+app.conf.task_queues = [
+    Queue('{}_tasks'.format(name), task_exchange,
+          routing_key='tasks.{}'.format(name), queue_arguments=_QUEUE_ARGS)
+    for name in sorted(SCAN_PRIORITIES, key=SCAN_PRIORITIES.get)
+]
+app.conf.task_default_queue = 'medium_tasks'
+app.conf.task_default_exchange = 'tasks'
+app.conf.task_default_routing_key = 'tasks.medium'
+app.conf.worker_prefetch_multiplier = 1
+app.conf.task_acks_late = True
+app.conf.task_reject_on_worker_lost = True
+# Scan modules can leak memory (yara rules, libmagic handles, ...), so
+# prefork children are replaced after a number of tasks, or once their
+# resident memory passes the limit. 0 or an empty value turns either off
+app.conf.worker_max_tasks_per_child = _recycle_limit(worker_config, 'max_tasks_per_child')
+app.conf.worker_max_memory_per_child = _recycle_limit(worker_config, 'max_memory_per_child_kb')
 db = database.Database(config=db_config)
+# Shared by every task run in this worker process, see init_worker_process
+storage_handler = None
+_post_pool = None
+_POST_POOL_SIZE = 2
+# Limits how many finished scans can wait for post-processing. Once they
+# are all taken, the next task blocks instead of piling up results that
+# have already been acknowledged
+_post_slots = threading.BoundedSemaphore(2 * _POST_POOL_SIZE)
+
+# Finished reports are buffered and sent to storage together, once
+# flush_every reports are waiting or flush_interval seconds have passed
+flush_every = int(worker_config.get('flush_every', DEFAULTCONF['flush_every']))
+flush_interval = float(worker_config.get('flush_interval', DEFAULTCONF['flush_interval']))
+# Store reports before the task returns (and is acknowledged) instead of
+# in the background, see the module docstring
+store_before_ack = worker_config.get('store_before_ack', False) is True
+_report_buffer = deque()
+_report_buffer_lock = threading.Lock()
+_flush_timer = None
+
+# Task DB updates are queued and written in bulk by a background thread,
+# every flush_every updates or flush_interval seconds
+_task_updates = queue.Queue()
+_task_writer = None
+_task_writer_lock = threading.Lock()
+
+# Scan config file path -> (modification time, summary)
+_config_summaries = {}
 
 
 @app.on_after_configure.connect
@@ -82,133 +223,491 @@ def setup_periodic_tasks(sender, **kwargs):
 
     # Delete old metricbeat indices
     # Executes every morning at 3:00 a.m.
-    metricbeat_enabled = es_storage_config.get('metricbeat_enabled', True)
-    if metricbeat_enabled:
+    if ES_CFG.metricbeat_enabled:
         sender.add_periodic_task(
             crontab(hour=3, minute=0),
-            metricbeat_rollover.s(days=es_storage_config.get('metricbeat_rollover_days')),
+            metricbeat_rollover.s(days=ES_CFG.metricbeat_rollover_days),
         )
 
 
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    # Connect to the task DB and storage once per worker process
+    # instead of once per task
+    db.init_db()
+    _get_post_pool()
+    try:
+        _get_storage_handler()
+    except storage.StorageNotLoadedError as e:
+        # Try again when the first reports are flushed
+        logger.error('Failed to load storage: %s', e)
+
+
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    # Don't lose scans still being post-processed or reports still
+    # waiting in the buffer
+    global _post_pool, storage_handler
+    if _post_pool is not None:
+        _post_pool.close()
+        _post_pool.join()
+        _post_pool = None
+    flush_reports()
+    flush_task_updates()
+    if storage_handler is not None:
+        storage_handler.close()
+        storage_handler = None
+
+
+@worker_shutdown.connect
+def shutdown_worker(**kwargs):
+    # With the solo, threads, gevent and eventlet pools, tasks run in the
+    # main worker process, which never gets worker_process_shutdown
+    shutdown_worker_process()
+
+
+def _init_db():
+    if db.db_engine is None:
+        db.init_db()
+
+
+def _get_storage_handler():
+    '''
+    Return this process's storage handler, loading it on first use. Tasks
+    run outside of a prefork child never get worker_process_init.
+    '''
+    global storage_handler
+    if storage_handler is None:
+        storage_handler = storage.StorageHandler(configfile=storage_configfile)
+    return storage_handler
+
+
+def _get_es_storage():
+    '''
+    Return this process's Elasticsearch storage module, or None if it
+    isn't loaded
+    '''
+    return _get_storage_handler().loaded_storage.get('ElasticSearchStorage')
+
+
+def _get_post_pool():
+    global _post_pool
+    if _post_pool is None:
+        _post_pool = ThreadPool(processes=_POST_POOL_SIZE)
+    return _post_pool
+
+
+def _queue_task_updates(task_ids, task_status, timestamp):
+    '''
+    Queue a status update for each of the given tasks, to be written to the
+    task DB by this process's task writer thread
+    '''
+    _get_task_writer()
+    for task_id in task_ids:
+        _task_updates.put((task_id, task_status, timestamp))
+
+
+def _get_task_writer():
+    global _task_writer
+    with _task_writer_lock:
+        # A thread started before a fork doesn't exist in the child
+        if _task_writer is None or not _task_writer.is_alive():
+            _task_writer = threading.Thread(target=_write_task_updates)
+            _task_writer.daemon = True
+            _task_writer.start()
+    return _task_writer
+
+
+def _write_task_updates():
+    '''
+    Loop forever, writing queued task updates to the task DB in batches.
+    A None in the queue makes the current batch be written straight away.
+    '''
+    while True:
+        updates = []
+        flush_now = False
+        item = _task_updates.get()
+        # Start the clock once there is something to write, not while idle
+        deadline = time.time() + flush_interval
+        while True:
+            if item is None:
+                flush_now = True
+            else:
+                updates.append(item)
+            if flush_now or len(updates) >= flush_every:
+                break
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = _task_updates.get(timeout=timeout)
+            except queue.Empty:
+                break
+
+        try:
+            if updates:
+                _store_task_updates(updates)
+        finally:
+            # One task_done() per item taken off the queue, including the
+            # None that asked for the flush
+            for _ in range(len(updates) + int(flush_now)):
+                _task_updates.task_done()
+
+
+def _store_task_updates(updates):
+    '''
+    Write a batch of task updates to the task DB. If the batch fails, each
+    update is retried on its own so one bad update can't lose the others.
+    '''
+    try:
+        _init_db()
+        db.update_tasks(updates)
+        written = updates
+    except Exception as e:
+        logger.error('Failed to update %d tasks in bulk, retrying one at a time: %s',
+                     len(updates), e)
+        written = []
+        for update in updates:
+            task_id, task_status, timestamp = update
+            try:
+                db.update_task(
+                    task_id=task_id,
+                    task_status=task_status,
+                    timestamp=timestamp,
+                )
+                written.append(update)
+            except Exception as e:
+                logger.error('Failed to set task #%s to %s: %s', task_id, task_status, e)
+
+    for task_id, task_status, _ in written:
+        if task_status == 'Complete':
+            logger.info('Completed Task #%s', task_id)
+
+
+def flush_task_updates():
+    '''
+    Write all queued task updates to the task DB and wait until they are
+    written
+    '''
+    if _task_writer is None:
+        # Nothing was ever queued in this process
+        return
+    _get_task_writer()
+    _task_updates.put(None)
+    _task_updates.join()
+
+
+def _buffer_report(task_id, scan_time, report):
+    '''
+    Add a finished report to the storage buffer, flushing it if full.
+    Otherwise make sure a flush is scheduled for flush_interval seconds
+    from now.
+    '''
+    global _flush_timer
+    with _report_buffer_lock:
+        _report_buffer.append((task_id, scan_time, report))
+        full = len(_report_buffer) >= flush_every
+        if not full and _flush_timer is None:
+            _flush_timer = threading.Timer(flush_interval, flush_reports)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+    if full:
+        flush_reports()
+
+
+def _merge_reports(reports):
+    '''
+    Merge reports into as few dictionaries as possible without two reports
+    for the same filename overwriting each other
+    '''
+    merged = []
+    for report in reports:
+        for filename, file_report in report.items():
+            for results in merged:
+                if filename not in results:
+                    results[filename] = file_report
+                    break
+            else:
+                merged.append({filename: file_report})
+    return merged
+
+
+def flush_reports():
+    '''
+    Save all buffered reports to storage with one call to the storage
+    handler per batch, then queue the updates for their tasks
+    '''
+    global _flush_timer
+    with _report_buffer_lock:
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        batch = list(_report_buffer)
+        _report_buffer.clear()
+
+    if not batch:
+        return
+
+    task_status = 'Complete'
+    try:
+        handler = _get_storage_handler()
+        for results in _merge_reports(report for _, _, report in batch):
+            handler.store(results)
+    except Exception as e:
+        logger.error('Failed to store %d reports: %s', len(batch), e)
+        task_status = 'Failed'
+
+    # Queue the results to be written to the task DB
+    _get_task_writer()
+    for task_id, scan_time, _ in batch:
+        _task_updates.put((task_id, task_status, scan_time))
+
+
+def priority_options(priority):
+    '''
+    Return the apply_async options that send a task to the queue for the
+    given priority ('low', 'medium' or 'high')
+    '''
+    return {
+        'queue': '{}_tasks'.format(priority),
+        'routing_key': 'tasks.{}'.format(priority),
+        'priority': SCAN_PRIORITIES[priority],
+    }
+
+
+def _summarize_config(config):
+    '''
+    Return the ENABLED setting of each module in the scan config, how many
+    modules are enabled, and how many sections the config has. Summaries
+    are cached per config file until it is modified. The returned dict is
+    shared between tasks, so it must not be changed.
+    '''
+    mtime = os.path.getmtime(config)
+    cached = _config_summaries.get(config)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    scan_config_object = configparser.SafeConfigParser()
+    scan_config_object.optionxform = str
+    scan_config_object.read(config)
+    full_conf = utils.parse_config(scan_config_object)
+
+    sub_conf = {}
+    # Count number of modules enabled out of total possible
+    # and add it to the Scan Metadata
+    total_enabled = 0
+    total_modules = len(full_conf.keys())
+    for key in full_conf:
+        if key == 'main':
+            continue
+        sub_conf[key] = {}
+        sub_conf[key]['ENABLED'] = full_conf[key]['ENABLED']
+        if sub_conf[key]['ENABLED'] is True:
+            total_enabled += 1
+
+    summary = (sub_conf, total_enabled, total_modules)
+    _config_summaries[config] = (mtime, summary)
+    return summary
+
+
 class MultiScannerTask(Task):
     '''
     Class of tasks that defines call backs to handle signals
     from celery
     '''
+    def get_task_ids(self, args, kwargs):
+        '''
+        Return the task DB IDs of the files scanned by a call to this task
+        '''
+        if 'task_id' in kwargs:
+            return [kwargs['task_id']]
+        return [args[2]]
+
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         '''
         When a task fails, update the task DB with a "Failed"
         status. Dump a traceback to local logs
         '''
-        logger.error('Task #{} failed'.format(args[2]))
-        logger.error('Traceback info:\n{}'.format(einfo))
-
-        # Initialize the connection to the task DB
-        db.init_db()
+        task_ids = self.get_task_ids(args, kwargs)
+        logger.error('Task #%s failed', ', #'.join(str(t) for t in task_ids))
+        logger.error('Traceback info:\n%s', einfo)
 
         scan_time = datetime.now().isoformat()
+        if store_before_ack:
+            # Record the failure before the task is acknowledged
+            _init_db()
+            db.update_tasks([(t, 'Failed', scan_time) for t in task_ids])
+        else:
+            # Queue the failure to be written to the task DB
+            _queue_task_updates(task_ids, 'Failed', scan_time)
 
-        # Update the task DB with the failure
-        db.update_task(
-            task_id=args[2],
-            task_status='Failed',
-            timestamp=scan_time,
-        )
 
-
-@app.task(base=MultiScannerTask)
-def multiscanner_celery(file_, original_filename, task_id, file_hash, metadata,
-                        config=MS_CONFIG, module_list=None):
+class MultiScannerBatchTask(MultiScannerTask):
     '''
-    Queue up multiscanner tasks
-
-    Usage:
-    from celery_worker import multiscanner_celery
-    multiscanner_celery.delay(full_path, original_filename, task_id,
-                              hashed_filename, metadata, config, module_list)
+    MultiScannerTask that scans a list of files in one call
     '''
+    def get_task_ids(self, args, kwargs):
+        batch = kwargs['batch'] if 'batch' in kwargs else args[0]
+        return [item[2] for item in batch]
 
-    # Initialize the connection to the task DB
-    db.init_db()
 
-    logger.info('\n\n{}{}Got file: {}.\nOriginal filename: {}.\n'.format('=' * 48, '\n', file_hash, original_filename))
-
-    # Get the storage config
-    storage_conf = utils.get_config_path(config, 'storage')
-    storage_handler = storage.StorageHandler(configfile=storage_conf)
+def _scan_files(batch, config, module_list):
+    '''
+    Scan a list of (file_, original_filename, task_id, file_hash, metadata)
+    tuples with a single multiscan run. Building and storing the reports is
+    handed off to this process's post-processing pool, so the task can
+    return and the worker can start on its next message. At most
+    2 * _POST_POOL_SIZE scans wait for post-processing at a time; after
+    that the task blocks until one is done. With store_before_ack, the reports are stored and the task DB updated
+    before returning instead.
+
+    Returns a small {'task_id': ..., 'scan_time': ...} summary per file.
+    The reports themselves are only available from storage.
+    '''
+    for file_, original_filename, task_id, file_hash, metadata in batch:
+        logger.info('\n\n%sGot file: %s.\nOriginal filename: %s.\n',
+                    _BANNER, file_hash, original_filename)
 
     resultlist = multiscan(
-        [file_],
+        [item[0] for item in batch],
         configfile=config,
         module_list=module_list
     )
-    results = parse_reports(resultlist, python=True)
 
     scan_time = datetime.now().isoformat()
 
+    if store_before_ack:
+        reports = _build_reports(batch, resultlist, scan_time, config, module_list)
+        _store_reports_now(reports, scan_time)
+    else:
+        _post_slots.acquire()
+        try:
+            _get_post_pool().apply_async(
+                _finalize_scan,
+                (batch, resultlist, scan_time, config, module_list)
+            )
+        except Exception:
+            _post_slots.release()
+            raise
+    return [{'task_id': item[2], 'scan_time': scan_time} for item in batch]
+
+
+def _finalize_scan(batch, resultlist, scan_time, config, module_list):
+    '''
+    Build a report for each file in the batch from the multiscan results
+    and queue it for storage. Runs in the post-processing pool, so any
+    error has to be recorded in the task DB here.
+    '''
+    try:
+        try:
+            reports = _build_reports(batch, resultlist, scan_time, config, module_list)
+        except Exception as e:
+            logger.error('Failed to build reports: %s', e)
+            _queue_task_updates([item[2] for item in batch], 'Failed', scan_time)
+            return
+
+        # Queue the reports to be saved to storage in bulk. The task DB is
+        # updated once they are stored
+        for task_id, report in reports:
+            _buffer_report(task_id, scan_time, report)
+    finally:
+        _post_slots.release()
+
+
+def _store_reports_now(reports, scan_time):
+    '''
+    Store a task's own (task_id, report) pairs and mark the tasks Complete,
+    bypassing the shared report buffer and task update queue. Errors are
+    raised, so the task fails instead.
+    '''
+    handler = _get_storage_handler()
+    for results in _merge_reports(report for _, report in reports):
+        # Call each storage module directly: StorageHandler.store() runs
+        # them in threads and doesn't pass their errors on
+        for storage_module in handler.loaded_storage.values():
+            storage_module.store(dict(results))
+
+    _init_db()
+    db.update_tasks([(task_id, 'Complete', scan_time) for task_id, _ in reports])
+    for task_id, _ in reports:
+        logger.info('Completed Task #%s', task_id)
+
+
+def _build_reports(batch, resultlist, scan_time, config, module_list):
+    '''
+    Build the report for each file in the batch from the multiscan results.
+    Returns a list of (task_id, report) pairs.
+    '''
+    results = parse_reports(resultlist, python=True)
+
     # Get the Scan Config that the task was run with and
     # add it to the task metadata
-    scan_config_object = configparser.SafeConfigParser()
-    scan_config_object.optionxform = str
-    scan_config_object.read(config)
-    full_conf = utils.parse_config(scan_config_object)
-    sub_conf = {}
-    # Count number of modules enabled out of total possible
-    # and add it to the Scan Metadata
-    total_enabled = 0
-    total_modules = len(full_conf.keys())
+    sub_conf, total_enabled, total_modules = _summarize_config(config)
 
     # Get the count of modules enabled from the module_list
     # if it exists, else count via the config
     if module_list:
+        sub_conf = {}
         total_enabled = len(module_list)
-    else:
-        for key in full_conf:
-            if key == 'main':
-                continue
-            sub_conf[key] = {}
-            sub_conf[key]['ENABLED'] = full_conf[key]['ENABLED']
-            if sub_conf[key]['ENABLED'] is True:
-                total_enabled += 1
-
-    results[file_]['Scan Metadata'] = metadata
-    results[file_]['Scan Metadata']['Worker Node'] = gethostname()
-    results[file_]['Scan Metadata']['Scan Config'] = sub_conf
-    results[file_]['Scan Metadata']['Modules Enabled'] = '{} / {}'.format(
-        total_enabled, total_modules
-    )
-    results[file_]['Scan Metadata']['Scan Time'] = scan_time
-    results[file_]['Scan Metadata']['Task ID'] = task_id
-
-    # Use the original filename as the value for the filename
-    # in the report (instead of the tmp path assigned to the file
-    # by the REST API)
-    results[original_filename] = results[file_]
-    del results[file_]
-
-    # Save the reports to storage
-    storage_ids = storage_handler.store(results, wait=False)
-    storage_handler.close()
-
-    # Only need to raise ValueError here,
-    # Further cleanup will be handled by the on_failure method
-    # of MultiScannerTask
-    if not storage_ids:
-        raise ValueError('Report failed to index')
-
-    # Update the task DB to reflect that the task is done
-    db.update_task(
-        task_id=task_id,
-        task_status='Complete',
-        timestamp=scan_time,
-    )
 
-    logger.info('Completed Task #{}'.format(task_id))
+    reports = []
+    for file_, original_filename, task_id, file_hash, metadata in batch:
+        # Use the original filename as the value for the filename
+        # in the report (instead of the tmp path assigned to the file
+        # by the REST API)
+        file_report = results.pop(file_)
+        report = {original_filename: file_report}
+
+        scan_metadata = dict(metadata)
+        file_report['Scan Metadata'] = scan_metadata
+        scan_metadata['Worker Node'] = WORKER_HOSTNAME
+        scan_metadata['Scan Config'] = sub_conf
+        scan_metadata['Modules Enabled'] = '{} / {}'.format(
+            total_enabled, total_modules
+        )
+        scan_metadata['Scan Time'] = scan_time
+        scan_metadata['Task ID'] = task_id
+        reports.append((task_id, report))
+    return reports
+
+
+@app.task(base=MultiScannerTask, **priority_options('medium'))
+def multiscanner_celery(file_, original_filename, task_id, file_hash, metadata,
+                        config=MS_CONFIG, module_list=None):
+    '''
+    Queue up multiscanner tasks
+
+    Usage:
+    from celery_worker import multiscanner_celery
+    multiscanner_celery.delay(full_path, original_filename, task_id,
+                              hashed_filename, metadata, config, module_list)
+
+    Scans go to the medium priority queue by default. To expedite one:
+    multiscanner_celery.apply_async(
+        args=(full_path, original_filename, task_id, hashed_filename, metadata),
+        **priority_options('high'))
+    '''
+    batch = [(file_, original_filename, task_id, file_hash, metadata)]
+    return _scan_files(batch, config, module_list)[0]
 
-    return results
 
+@app.task(base=MultiScannerBatchTask, **priority_options('medium'))
+def multiscanner_celery_batch(batch, config=MS_CONFIG, module_list=None):
+    '''
+    Queue up a multiscanner task for several files at once, so they share
+    a single multiscan run
 
-@app.task()
+    Usage:
+    from celery_worker import multiscanner_celery_batch
+    multiscanner_celery_batch.delay([(full_path, original_filename, task_id,
+                                      hashed_filename, metadata), ...],
+                                    config, module_list)
+    '''
+    return _scan_files(batch, config, module_list)
+
+
+@app.task(**priority_options('low'))
 def ssdeep_compare_celery():
     '''
     Run ssdeep.compare for new samples.
@@ -217,42 +716,49 @@ def ssdeep_compare_celery():
     from celery_worker import ssdeep_compare_celery
     ssdeep_compare_celery.delay()
     '''
+    # Only needed once a night, so don't load it into every worker process
+    from multiscanner.analytics.ssdeep_analytics import UNANALYZED_QUERY, SSDeepAnalytic
+
+    # Skip the analytic, and the storage connection it opens, when no
+    # sample is waiting to be compared
+    es_storage = _get_es_storage()
+    if es_storage is not None:
+        new_samples = es_storage.es.count(
+            index=es_storage.index, body={'query': UNANALYZED_QUERY}
+        )['count']
+        if not new_samples:
+            logger.debug('No new samples for ssdeep.compare, exiting...')
+            return
+
     ssdeep_analytic = SSDeepAnalytic()
     ssdeep_analytic.ssdeep_compare()
 
 
-@app.task()
+@app.task(**priority_options('low'))
 def metricbeat_rollover(days, config=MS_CONFIG):
     '''
     Clean up old Elastic Beats indices
     '''
-    try:
-        # Get the storage config
-        storage_handler = storage.StorageHandler(configfile=storage_configfile)
-        metricbeat_enabled = es_storage_config.get('metricbeat_enabled', True)
+    if not ES_CFG.metricbeat_enabled:
+        logger.debug('Metricbeat logging not enbaled, exiting...')
+        return
 
-        if not metricbeat_enabled:
-            logger.debug('Metricbeat logging not enbaled, exiting...')
-            return
-
-        if not days:
-            days = es_storage_config.get('metricbeat_rollover_days')
+    try:
         if not days:
-            raise NameError("name 'days' is not defined, check storage.ini for 'metricbeat_rollover_days' setting")
-
-        # Find Elastic storage
-        for handler in storage_handler.loaded_storage:
-            if isinstance(handler, elasticsearch_storage.ElasticSearchStorage):
-                ret = handler.delete_index(index_prefix='metricbeat', days=days)
-
-                if ret is False:
-                    logger.warn('Metricbeat Roller failed')
-                else:
-                    logger.info('Metricbeat indices older than {} days deleted'.format(days))
+            days = ES_CFG.metricbeat_rollover_days
+
+        # Find Elastic storage. The handler is shared with the scan tasks,
+        # so it stays open
+        es_storage = _get_es_storage()
+        if es_storage is not None:
+            ret = es_storage.delete_index(index_prefix='metricbeat', days=days)
+
+            if ret is False:
+                logger.warn('Metricbeat Roller failed')
+            else:
+                logger.info('Metricbeat indices older than %s days deleted', days)
     except Exception as e:
         logger.warn(e)
-    finally:
-        storage_handler.close()
 
 
 if __name__ == '__main__':
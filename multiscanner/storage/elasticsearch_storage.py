@@ -11,7 +11,14 @@ from uuid import uuid4
 import curator
 
 from elasticsearch import Elasticsearch, helpers
-from elasticsearch.exceptions import TransportError
+from elasticsearch.compat import string_types
+from elasticsearch.exceptions import SerializationError, TransportError
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from multiscanner import MS_WD
 from multiscanner.storage import storage
@@ -28,6 +35,26 @@ METADATA_FIELDS = [
 ES_MAX = 2147483647
 ES_TEMPLATE = os.path.join(MS_WD, 'storage', 'templates', 'elasticsearch_template.json')
 ES_TEMPLATE_NAME = 'multiscanner_template'
+ES_BULK_THREADS = 4
+
+
+class OrjsonSerializer(JSONSerializer):
+    '''
+    JSONSerializer that encodes request bodies with orjson, which is several
+    times faster than json on large nested reports.
+    '''
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, string_types):
+            return data
+
+        try:
+            return orjson.dumps(
+                data, default=self.default, option=orjson.OPT_NON_STR_KEYS
+            ).decode('utf-8')
+        except TypeError:
+            # orjson is stricter than json, e.g. about integers over 64 bits
+            return super(OrjsonSerializer, self).dumps(data)
 
 
 def process_cuckoo_signatures(signatures):
@@ -84,9 +111,13 @@ class ElasticSearchStorage(storage.Storage):
         self.port = self.config['port']
         self.index = self.config['index']
         self.doc_type = '_doc'
+        es_kwargs = {}
+        if orjson is not None:
+            es_kwargs['serializer'] = OrjsonSerializer()
         self.es = Elasticsearch(
             hosts=self.hosts,
-            port=self.port
+            port=self.port,
+            **es_kwargs
         )
 
         # Reduce traceback output from the elasticsearch module
@@ -160,6 +191,7 @@ class ElasticSearchStorage(storage.Storage):
     def store(self, report):
         sample_ids = {}
         sample_list = []
+        report_list = []
         sample_tags = {}  # track in case we need to update sample instead of create
 
         for filename in report:
@@ -209,31 +241,24 @@ class ElasticSearchStorage(storage.Storage):
 
                 report[filename]['Cuckoo Sandbox'] = cuckoo_doc
 
-            # Store report; let ES autogenerate the ID so we can save it with the sample
-            try:
-                report_result = self.es.index(index=self.index, doc_type=self.doc_type,
-                                              body=report[filename],
-                                              pipeline='dedot', routing=sample_id)
-            except (TransportError, UnicodeEncodeError) as e:
-                # If fail, index empty doc instead
-                print('Failed to index that report!\n{}'.format(e))
-                report_body_fail = {
-                    'doc_type': {
-                        'name': 'report',
-                        'parent': sample_id,
-                    },
-                    'ERROR': 'Failed to index the full report in Elasticsearch',
-                }
-                if 'Scan Time' in report[filename]:
-                    report_body_fail['Scan Time'] = report[filename]['Scan Time']
-                report_result = self.es.index(index=self.index, doc_type=self.doc_type,
-                                              body=report_body_fail,
-                                              pipeline='dedot', routing=sample_id)
-
-            report_id = report_result.get('_id')
+            # Generate the report ID up front so the sample can reference
+            # it before the reports are bulk indexed
+            report_id = uuid4().hex
             sample['report_id'] = report_id
             sample_ids[sample_id] = report_id
 
+            report_list.append(
+                {
+                    '_op_type': 'index',
+                    '_index': self.index,
+                    '_type': self.doc_type,
+                    '_id': report_id,
+                    '_routing': sample_id,
+                    '_source': report[filename],
+                    'pipeline': 'dedot'
+                }
+            )
+
             sample_list.append(
                 {
                     '_op_type': 'create',
@@ -245,6 +270,8 @@ class ElasticSearchStorage(storage.Storage):
                 }
             )
 
+        self._bulk_index_reports(report_list)
+
         result = helpers.bulk(self.es, sample_list, raise_on_error=False)
 
         creation_errors = result[1]
@@ -274,6 +301,49 @@ class ElasticSearchStorage(storage.Storage):
         result = helpers.bulk(self.es, updates_list, raise_on_error=False)
         return sample_ids
 
+    def _bulk_index_reports(self, report_list):
+        '''Index reports with parallel bulk requests. Reports that fail are
+        retried individually so that an error document can be indexed in
+        their place.
+        '''
+        failed = set()
+        try:
+            for ok, item in helpers.parallel_bulk(self.es, report_list,
+                                                  thread_count=ES_BULK_THREADS,
+                                                  raise_on_error=False):
+                if not ok:
+                    failed.add(item['index']['_id'])
+        except (TransportError, UnicodeEncodeError, SerializationError) as e:
+            print('Failed to bulk index reports!\n{}'.format(e))
+            # Reports keep their IDs, so re-indexing one that did make it
+            # in just overwrites it
+            failed = set(action['_id'] for action in report_list)
+
+        for action in report_list:
+            if action['_id'] in failed:
+                self._index_report(action)
+
+    def _index_report(self, action):
+        try:
+            self.es.index(index=self.index, doc_type=self.doc_type,
+                          id=action['_id'], body=action['_source'],
+                          pipeline='dedot', routing=action['_routing'])
+        except (TransportError, UnicodeEncodeError, SerializationError) as e:
+            # If fail, index empty doc instead
+            print('Failed to index that report!\n{}'.format(e))
+            report_body_fail = {
+                'doc_type': {
+                    'name': 'report',
+                    'parent': action['_routing'],
+                },
+                'ERROR': 'Failed to index the full report in Elasticsearch',
+            }
+            if 'Scan Time' in action['_source']:
+                report_body_fail['Scan Time'] = action['_source']['Scan Time']
+            self.es.index(index=self.index, doc_type=self.doc_type,
+                          id=action['_id'], body=report_body_fail,
+                          pipeline='dedot', routing=action['_routing'])
+
     def get_report(self, sample_id, timestamp):
         '''Find a report for the given sample at the given timestamp, and
         return the report with sample metadata included.
@@ -9,8 +9,8 @@ from contextlib import contextmanager
 from datetime import datetime
 
 from datatables import ColumnDT, DataTables
-from sqlalchemy import (Column, DateTime, Integer, String, and_, create_engine,
-                        func)
+from sqlalchemy import (Column, DateTime, Integer, String, and_, bindparam,
+                        create_engine, func)
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import aliased, sessionmaker
@@ -25,6 +25,17 @@ Base = declarative_base()
 Session = sessionmaker()
 
 
+def _parse_timestamp(timestamp):
+    '''
+    Parse an ISO 8601 timestamp as written by datetime.isoformat(), which
+    leaves out the microseconds when they are 0
+    '''
+    try:
+        return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+    except ValueError:
+        return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S')
+
+
 class Task(Base):
     __tablename__ = "Tasks"
 
@@ -177,9 +188,45 @@ class Database(object):
             if task:
                 task.task_status = task_status
                 if timestamp:
-                    task.timestamp = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f')
+                    task.timestamp = _parse_timestamp(timestamp)
                 return task.to_dict()
 
+    def update_tasks(self, updates):
+        '''Update several tasks in a single transaction.
+
+        Args:
+            updates: Iterable of (task_id, task_status, timestamp) tuples.
+                As with update_task, timestamp may be None to leave it
+                unchanged. A timestamp that can't be parsed is also left
+                unchanged, so it doesn't fail the rest of the batch.
+        '''
+        tasks = Task.__table__
+        query = tasks.update().where(tasks.c.task_id == bindparam('_task_id'))
+        with_timestamp = []
+        without_timestamp = []
+        for task_id, task_status, timestamp in updates:
+            params = {'_task_id': task_id, '_task_status': task_status}
+            if timestamp:
+                try:
+                    params['_timestamp'] = _parse_timestamp(timestamp)
+                except ValueError:
+                    print('Invalid timestamp for task {}: {}'.format(task_id, timestamp))
+            if '_timestamp' in params:
+                with_timestamp.append(params)
+            else:
+                without_timestamp.append(params)
+
+        with self.db_session_scope() as ses:
+            # One executemany per statement, instead of a query and an
+            # UPDATE per task
+            if with_timestamp:
+                ses.execute(query.values(task_status=bindparam('_task_status'),
+                                         timestamp=bindparam('_timestamp')),
+                            with_timestamp)
+            if without_timestamp:
+                ses.execute(query.values(task_status=bindparam('_task_status')),
+                            without_timestamp)
+
     def get_task(self, task_id):
         with self.db_session_scope() as ses:
             task = ses.query(Task).get(task_id)
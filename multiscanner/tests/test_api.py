@@ -44,7 +44,7 @@ def post_file(app):
         data={'file': (BytesIO(b'my file contents'), 'hello world.txt'), })
 
 
-def mock_delay(full_path, original_filename, task_id, f_name, metadata, config):
+def mock_apply_async(args=None, kwargs=None, **options):
     pass
 
 
@@ -67,7 +67,7 @@ class APITestCase(unittest.TestCase):
 class TestURLCase(APITestCase):
     def setUp(self):
         super(self.__class__, self).setUp()
-        api.multiscanner_celery.delay = mock_delay
+        api.multiscanner_celery.apply_async = mock_apply_async
 
     def test_index(self):
         expected_response = {'Message': 'True'}
@@ -87,6 +87,27 @@ class TestURLCase(APITestCase):
         self.assertEqual(resp.status_code, api.HTTP_CREATED)
         self.assertEqual(json.loads(resp.get_data().decode()), expected_response)
 
+    def test_create_task_invalid_priority(self):
+        resp = self.app.post(
+            '/api/v1/tasks',
+            data={'file': (BytesIO(b'my file contents'), 'hello world.txt'),
+                  'priority': 'urgent'})
+        self.assertEqual(resp.status_code, api.HTTP_BAD_REQUEST)
+
+    @mock.patch('multiscanner.distributed.api.multiscanner_celery_batch')
+    def test_queue_tasks_batched(self, mock_batch):
+        files = [('{}.txt'.format(i), 'hash{}'.format(i), '/tmp/hash{}'.format(i)) for i in range(3)]
+        with mock.patch.object(api, 'DISTRIBUTED', True), mock.patch.object(api, 'celery_batch_size', 2):
+            task_ids = api.queue_tasks(files, {})
+
+        self.assertEqual(task_ids, [1, 2, 3])
+        self.assertEqual(mock_batch.apply_async.call_count, 2)
+        args, kwargs = mock_batch.apply_async.call_args_list[0]
+        self.assertEqual(
+            kwargs['args'][0],
+            [('/tmp/hash0', '0.txt', 1, 'hash0', {}), ('/tmp/hash1', '1.txt', 2, 'hash1', {})]
+        )
+
     def test_get_modules(self):
         resp = self.app.get('/api/v1/modules').get_data().decode('utf-8')
         self.assertIn('Modules', resp)
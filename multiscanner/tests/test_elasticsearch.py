@@ -1,6 +1,8 @@
 '''
 Module for testing the Elasticsearch datastore.
 '''
+import copy
+import json
 import os
 import mock
 import unittest
@@ -11,6 +13,7 @@ from elasticsearch.client import IndicesClient, IngestClient
 CWD = os.path.dirname(os.path.abspath(__file__))
 MS_WD = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+from multiscanner.storage import elasticsearch_storage
 from multiscanner.storage.elasticsearch_storage import ElasticSearchStorage
 
 TEST_MS_OUTPUT = {'test.txt': {'SHA1': '02bed644797a7adb7d9e3fe8246cc3e1caed0dfe', 'MD5': 'd74129f99f532292de5db9a90ec9d424', 'libmagic': 'ASCII text, with very long lines, with no line terminators', 'ssdeep': '6:BLWw/ELmRCp8o7cu5eul3tkxZBBCGAAIwLE/mUz9kLTCDFM1K7NBVn4+MUq08:4w/ELmR48oJh1exX8G7TW+wM1uFwp', 'SHA256': '03a634eb98ec54d5f7a3c964a82635359611d84dd4ba48e860e6d4817d4ca2a6', 'Metadata': {}, "Scan Time": "2017-09-26T16:48:05.395004"}}    # noqa: E501
@@ -28,11 +31,11 @@ class TestES(unittest.TestCase):
         self.handler = ElasticSearchStorage(config=ElasticSearchStorage.DEFAULTCONF)
         self.handler.setup()
 
-    @mock.patch.object(Elasticsearch, 'index')
     @mock.patch('multiscanner.storage.elasticsearch_storage.helpers')
-    def test_store(self, mock_helpers, mock_index):
+    def test_store(self, mock_helpers):
         mock_helpers.bulk.return_value = (1, [])
-        resp = self.handler.store(TEST_MS_OUTPUT)
+        mock_helpers.parallel_bulk.return_value = []
+        resp = self.handler.store(copy.deepcopy(TEST_MS_OUTPUT))
 
         args, kwargs = mock_helpers.bulk.call_args_list[0]
         sample_args = args[1][0]
@@ -41,15 +44,29 @@ class TestES(unittest.TestCase):
         self.assertEqual(sample_args['_source']['SHA256'], TEST_ID)
         self.assertEqual(sample_args['_source']['tags'], [])
 
-        report_args, report_kwargs = mock_index.call_args_list[0]
-        self.assertEqual(report_kwargs['routing'], TEST_ID)
+        args, kwargs = mock_helpers.parallel_bulk.call_args_list[0]
+        report_args = args[1][0]
+        self.assertEqual(report_args['_routing'], TEST_ID)
         self.assertEqual(
-            report_kwargs['body']['libmagic'],
+            report_args['_source']['libmagic'],
             'ASCII text, with very long lines, with no line terminators')
-        self.assertEqual(report_kwargs['pipeline'], 'dedot')
+        self.assertEqual(report_args['pipeline'], 'dedot')
+        self.assertEqual(report_args['_id'], sample_args['_source']['report_id'])
 
         self.assertIn(TEST_ID, resp)
 
+    @mock.patch.object(Elasticsearch, 'index')
+    @mock.patch('multiscanner.storage.elasticsearch_storage.helpers')
+    def test_store_failed_report(self, mock_helpers, mock_index):
+        mock_helpers.bulk.return_value = (1, [])
+        mock_helpers.parallel_bulk.side_effect = lambda es, actions, **kwargs: [
+            (False, {'index': {'_id': action['_id'], 'status': 400}}) for action in actions]
+        self.handler.store(copy.deepcopy(TEST_MS_OUTPUT))
+
+        report_args, report_kwargs = mock_index.call_args_list[0]
+        self.assertEqual(report_kwargs['routing'], TEST_ID)
+        self.assertEqual(report_kwargs['pipeline'], 'dedot')
+
     @mock.patch.object(Elasticsearch, 'search')
     @mock.patch.object(Elasticsearch, 'get')
     def test_get_report(self, mock_get, mock_search):
@@ -227,3 +244,16 @@ class TestES(unittest.TestCase):
 
     def tearDown(self):
         self.handler.teardown()
+
+
+@unittest.skipIf(elasticsearch_storage.orjson is None, 'orjson not installed')
+class TestOrjsonSerializer(unittest.TestCase):
+    def test_dumps(self):
+        serializer = elasticsearch_storage.OrjsonSerializer()
+        self.assertEqual(serializer.dumps('{"a": 1}'), '{"a": 1}')
+        self.assertEqual(json.loads(serializer.dumps(TEST_MS_OUTPUT)), TEST_MS_OUTPUT)
+
+    def test_dumps_fallback(self):
+        # Too big for orjson, so this goes through json instead
+        serializer = elasticsearch_storage.OrjsonSerializer()
+        self.assertEqual(json.loads(serializer.dumps({'a': 2 ** 70})), {'a': 2 ** 70})
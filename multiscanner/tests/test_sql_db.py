@@ -123,6 +123,33 @@ class TestTaskManipulation(unittest.TestCase):
         self.assertDictEqual(resp, self.sql_db.get_task(1).to_dict())
         self.assertDictEqual(resp, {'task_id': 1, 'sample_id': None, 'task_status': 'Complete', 'timestamp': None})
 
+    def test_update_tasks(self):
+        self.sql_db.add_task()
+        self.sql_db.update_tasks([
+            (1, 'Complete', '2018-01-01T00:00:00.000000'),
+            (2, 'Failed', None),
+            (3, 'Complete', None),
+        ])
+        task = self.sql_db.get_task(1)
+        self.assertEqual(task.task_status, 'Complete')
+        self.assertEqual(task.timestamp.year, 2018)
+        self.assertEqual(self.sql_db.get_task(2).task_status, 'Failed')
+        self.assertEqual(self.sql_db.get_task(3), None)
+
+    def test_update_tasks_bad_timestamp(self):
+        self.sql_db.add_task()
+        self.sql_db.update_tasks([
+            # isoformat() leaves out the microseconds when they are 0
+            (1, 'Complete', '2018-01-01T00:00:00'),
+            (2, 'Failed', 'not a timestamp'),
+        ])
+        task = self.sql_db.get_task(1)
+        self.assertEqual(task.task_status, 'Complete')
+        self.assertEqual(task.timestamp.year, 2018)
+        task = self.sql_db.get_task(2)
+        self.assertEqual(task.task_status, 'Failed')
+        self.assertEqual(task.timestamp, None)
+
     def test_delete_task(self):
         deleted = self.sql_db.delete_task(task_id=1)
         self.assertTrue(deleted)